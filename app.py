@@ -27,15 +27,21 @@ from discord.ext import commands, tasks
 from discord import opus as discord_opus
 import os
 import sys
+import signal
 import time
 import asyncio
 import subprocess
-import glob
-import io
+import re
+import shutil
+import tempfile
+import errno
+import mmap
 import struct
+import fcntl
 import threading
 import logging
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date
 from enum import Enum, auto
 
 import nacl.secret
@@ -60,27 +66,75 @@ except ImportError:
 TOKEN           = os.getenv('DISCORD_TOKEN')
 CHUNK_SECONDS   = int(os.getenv('CHUNK_TIME', 300))
 BASE_DIR        = os.getenv('BASE_DIR', 'recordings')
-CHECK_INTERVAL  = 3
+CHECK_INTERVAL  = 15
 LEAVE_COOLDOWN  = 10
+JOIN_BURST      = 3         # joins allowed back to back per guild...
+JOIN_RATE       = 1 / 30    # ...refilled at one per 30s
+KEEP_CHUNKS     = os.getenv('KEEP_CHUNKS', '').lower() in ('1', 'true', 'yes')
+SPOOL_DIR       = os.getenv('SPOOL_DIR', '')   # back PCM buffers with files here instead of RAM
+FFMPEG_PARALLELISM = int(os.getenv('FFMPEG_PARALLELISM', 0)) or max(2, (os.cpu_count() or 1) // 2)
+COPY_BUFSIZE    = 1 << 20
+SEP             = os.sep
+BASE_DIR_SEP    = BASE_DIR.rstrip(SEP) + SEP if BASE_DIR else ''
+PIPE_BUFSIZE    = 1 << 20
+
+# Absolute path plus close_fds=False lets subprocess take the posix_spawn
+# fast path. Python's own fds are non-inheritable, so nothing leaks.
+FFMPEG          = shutil.which('ffmpeg') or 'ffmpeg'
+# Opened once and handed to every spawn, instead of subprocess opening /dev/null each time
+DEVNULL_FD      = os.open(os.devnull, os.O_RDWR)
+# Chunks are byte-appended to the daily file, so each must be a bare run of
+# self-contained CBR frames: no bit reservoir reaching into the previous
+# chunk, and no ID3/Xing header landing mid-file.
+MP3_ENCODE_ARGS = ['-c:a', 'libmp3lame', '-b:a', '128k', '-reservoir', '0',
+                   '-id3v2_version', '0', '-write_xing', '0', '-f', 'mp3']
+# Host-wide cap on concurrent ffmpeg processes. Guilds share CHUNK_TIME, so
+# their rotations tend to land together and would otherwise oversubscribe.
+FFMPEG_SLOTS    = threading.BoundedSemaphore(FFMPEG_PARALLELISM)
 
 raw_channels = os.getenv('ALLOWED_CHANNELS', '')
-ALLOWED_CHANNELS: list = (
-    [int(x.strip()) for x in raw_channels.split(',') if x.strip().isdigit()]
-    if raw_channels else []
+ALLOWED_CHANNELS: frozenset = frozenset(
+    int(x.strip()) for x in raw_channels.split(',') if x.strip().isdigit()
 )
 
 raw_users = os.getenv('ALLOWED_USERS', '')
-ALLOWED_USERS: set = (
-    {int(x.strip()) for x in raw_users.split(',') if x.strip().isdigit()}
-    if raw_users else set()
+ALLOWED_USERS: frozenset = frozenset(
+    int(x.strip()) for x in raw_users.split(',') if x.strip().isdigit()
 )
 
+# Cached .env contents so whitelist edits don't re-read and re-scan the file
+ENV_PATH                = '.env'
+_env_lines:             list = []
+_env_mtime              = None
+_allowed_users_line_idx = None
+
+def _load_env_cache():
+    global _env_lines, _env_mtime, _allowed_users_line_idx
+    try:
+        with open(ENV_PATH) as f:
+            _env_lines = f.readlines()
+        _env_mtime = os.stat(ENV_PATH).st_mtime_ns
+    except FileNotFoundError:
+        _env_lines = []
+        _env_mtime = None
+    if _env_lines and not _env_lines[-1].endswith('\n'):
+        _env_lines[-1] += '\n'
+    _allowed_users_line_idx = next(
+        (i for i, line in enumerate(_env_lines) if line.startswith('ALLOWED_USERS=')),
+        None,
+    )
+
+_load_env_cache()
+
 print("Configuration loaded:")
 print(f"   Chunk time     : {CHUNK_SECONDS}s")
 print(f"   Check interval : {CHECK_INTERVAL}s")
 print(f"   Leave cooldown : {LEAVE_COOLDOWN}s")
-print(f"   Channel filter : {ALLOWED_CHANNELS or 'ALL'}")
-print(f"   User whitelist : {ALLOWED_USERS or 'EMPTY - no one will be recorded'}")
+print(f"   Keep chunks    : {KEEP_CHUNKS}")
+print(f"   PCM spool dir  : {SPOOL_DIR or 'memory'}")
+print(f"   ffmpeg procs   : {FFMPEG_PARALLELISM}")
+print(f"   Channel filter : {sorted(ALLOWED_CHANNELS) or 'ALL'}")
+print(f"   User whitelist : {sorted(ALLOWED_USERS) or 'EMPTY - no one will be recorded'}")
 
 # ==============================================================================
 # BOT STATE
@@ -88,12 +142,16 @@ print(f"   User whitelist : {ALLOWED_USERS or 'EMPTY - no one will be recorded'}
 
 class State(Enum):
     IDLE      = auto()
+    JOINING   = auto()
     RECORDING = auto()
     SAVING    = auto()
 
 guild_state:       dict = {}
 guild_cooldown:    dict = {}
+guild_join_tokens: dict = {}   # guild_id -> (tokens, last refill), see take_join_token
 user_paused_until: dict = {}
+voice_targets:     dict = {}   # guild_id -> {user_id: channel_id}, kept by voice events
+guild_left_events: dict = {}   # guild_id -> asyncio.Event, set when the bot leaves voice
 
 def get_state(guild_id: int) -> State:
     return guild_state.get(guild_id, State.IDLE)
@@ -102,142 +160,487 @@ def set_state(guild_id: int, state: State):
     guild_state[guild_id] = state
     print(f"   [state] guild {guild_id} -> {state.name}")
 
+def take_join_token(guild_id: int, now: float) -> float:
+    """
+    Token bucket guarding voice joins so deafen/undeafen flapping can't
+    reconnect in a loop and trip Discord's voice rate limits. Returns 0 if a
+    join may proceed, otherwise the seconds until the next token.
+    """
+    tokens, last = guild_join_tokens.get(guild_id, (JOIN_BURST, now))
+    tokens = min(JOIN_BURST, tokens + (now - last) * JOIN_RATE)
+    if tokens >= 1:
+        guild_join_tokens[guild_id] = (tokens - 1, now)
+        return 0.0
+    guild_join_tokens[guild_id] = (tokens, now)
+    return (1 - tokens) / JOIN_RATE
+
+def start_cooldown(guild_id: int, now: float = None):
+    """Block rejoins for LEAVE_COOLDOWN and re-check the guild once it lapses."""
+    guild_cooldown[guild_id] = (now if now is not None else time.monotonic()) + LEAVE_COOLDOWN
+    # A little slack so the check never lands just before the deadline
+    asyncio.get_event_loop().call_later(LEAVE_COOLDOWN + 0.1, schedule_evaluate, guild_id)
+
 # ==============================================================================
 # DISCORD BOT
 # ==============================================================================
 
-intents = discord.Intents.default()
+# Only what the bot reads: guild/voice state, member names, and text commands
+# in guilds and DMs. Everything else (typing, reactions, presences...) stays
+# off so the gateway doesn't dispatch it.
+intents = discord.Intents.none()
+intents.guilds          = True
+intents.voice_states    = True
+intents.members         = True
+intents.guild_messages  = True
+intents.dm_messages     = True
 intents.message_content = True
-intents.guilds = True
-intents.voice_states = True
-intents.members = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Voice members arrive with GUILD_CREATE and voice state events, so there's
+# no need to request every guild's full member list at startup.
+bot = commands.Bot(command_prefix="!", intents=intents, chunk_guilds_at_startup=False)
 
 # ==============================================================================
 # PAUSE HELPERS
 # ==============================================================================
 
-def is_user_paused(user_id: int) -> bool:
+# Whitelisted and not paused. The packet path tests only this, so it is
+# rebuilt on every whitelist or pause change instead of per packet.
+ACCEPTED_USERS: frozenset = ALLOWED_USERS
+
+def refresh_accepted_users():
+    global ACCEPTED_USERS
+    ACCEPTED_USERS = ALLOWED_USERS.difference(user_paused_until)
+
+def is_user_paused(user_id: int, now: float = None) -> bool:
+    # Read-only: expired deadlines are cleared by expire_pauses(), so readers
+    # never race a command handler over the del
     expiry = user_paused_until.get(user_id)
-    if expiry is None:
-        return False
-    if time.time() < expiry:
-        return True
-    del user_paused_until[user_id]
-    return False
+    return expiry is not None and (now if now is not None else time.monotonic()) < expiry
+
+def expire_pauses(now: float):
+    expired = [uid for uid, expiry in user_paused_until.items() if expiry <= now]
+    for uid in expired:
+        del user_paused_until[uid]
+    if expired:
+        refresh_accepted_users()
 
 def pause_user(user_id: int, minutes: int):
-    user_paused_until[user_id] = time.time() + minutes * 60
+    user_paused_until[user_id] = time.monotonic() + minutes * 60
+    refresh_accepted_users()
 
 def unpause_user(user_id: int):
     user_paused_until.pop(user_id, None)
+    refresh_accepted_users()
 
 # ==============================================================================
 # FILE HELPERS
 # ==============================================================================
 
+_today_cache = ['', float('-inf')]   # [date string, monotonic time it was computed]
+
 def today_str() -> str:
-    return datetime.now().strftime("%Y-%m-%d")
+    # Recomputed at most once a second; isoformat() skips the strftime parser
+    now = time.monotonic()
+    if now - _today_cache[1] > 1.0:
+        _today_cache[0] = date.today().isoformat()
+        _today_cache[1] = now
+    return _today_cache[0]
+
+# Same character set as str.isalnum(): \w is alnum plus underscore
+_UNSAFE_CHARS = re.compile(r'[\W_]+')
+
+_folder_cache: dict = {}   # user_id -> (user_name, folder path)
+
+def safe_name(user_name: str) -> str:
+    return _UNSAFE_CHARS.sub('', user_name)
 
 def user_folder(user_id: int, user_name: str) -> str:
-    safe = "".join(c for c in user_name if c.isalnum())
-    path = os.path.join(BASE_DIR, f"{safe}_{user_id}")
+    # Keyed by id but checked against the name, so a rename gets a fresh folder
+    cached = _folder_cache.get(user_id)
+    if cached is not None and cached[0] == user_name:
+        return cached[1]
+    path = f"{BASE_DIR_SEP}{safe_name(user_name)}_{user_id}"
     os.makedirs(path, exist_ok=True)
+    _folder_cache[user_id] = (user_name, path)
     return path
 
-def merge_chunks(folder: str, date_str: str):
-    chunks = sorted(glob.glob(os.path.join(folder, "*_part*.mp3")))
-    if not chunks:
+# Leftover chunk suffix; matched at the end so KEEP_CHUNKS files of a user
+# whose name happens to contain "_part" aren't swept into the merge
+_CHUNK_SUFFIX_RE = re.compile(r'_part\d+(?:_pre_pause)?\.mp3$')
+
+def scan_user_folder(folder: str):
+    """Single directory pass returning (leftover .pcm files, *_part*.mp3 chunks)."""
+    pcms, chunks = [], []
+    with os.scandir(folder) as it:
+        for entry in it:
+            # d_type from readdir, so this doesn't cost a stat()
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            name = entry.name
+            if name.endswith('.pcm'):
+                pcms.append(entry.path)
+            elif _CHUNK_SUFFIX_RE.search(name):
+                chunks.append(entry.path)
+    return pcms, chunks
+
+_PART_RE = re.compile(r'_part(\d+)')
+
+def _natural_key(path: str):
+    # Order by chunk number so part10 comes after part2
+    name = os.path.basename(path)
+    m = _PART_RE.search(name)
+    return (int(m.group(1)) if m else 0, name)
+
+_MP3_BITRATES = {
+    True:  (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),   # MPEG-1
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),       # MPEG-2/2.5
+}
+_MP3_RATES = (44100, 48000, 32000)
+
+def _skip_mp3_headers(src):
+    """
+    Seek src past a leading ID3v2 tag and Xing/Info header frame, if any.
+    Chunks encoded without MP3_ENCODE_ARGS carry both, and appending them
+    verbatim would drop a second header into the middle of the daily file.
+    """
+    pos  = 0
+    head = src.read(10)
+    if len(head) == 10 and head[:3] == b'ID3':
+        size = 0
+        for b in head[6:10]:
+            size = (size << 7) | (b & 0x7f)   # syncsafe integer
+        pos = 10 + size + (10 if head[5] & 0x10 else 0)
+    src.seek(pos)
+    frame = src.read(48)
+    src.seek(pos)
+    if len(frame) < 48:
+        return
+    h = int.from_bytes(frame[:4], 'big')
+    if h >> 21 != 0x7ff or (h >> 17) & 3 != 1:
+        return   # not an MPEG Layer III frame
+    version = (h >> 19) & 3
+    br_idx  = (h >> 12) & 0xf
+    sr_idx  = (h >> 10) & 3
+    if version == 1 or br_idx in (0, 15) or sr_idx == 3:
         return
+    mpeg1 = version == 3
+    rate  = _MP3_RATES[sr_idx] >> (0 if mpeg1 else 1 if version == 2 else 2)
+    mono  = (h >> 6) & 3 == 3
+    side  = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    if frame[4 + side:8 + side] in (b'Xing', b'Info'):
+        size = (144000 if mpeg1 else 72000) * _MP3_BITRATES[mpeg1][br_idx] // rate + ((h >> 9) & 1)
+        src.seek(pos + size)
+
+_HAS_FADVISE = hasattr(os, 'posix_fadvise')
+
+def _fadvise(fd: int, advice_name: str):
+    if _HAS_FADVISE:
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice_name))
+        except OSError:
+            pass
 
-    daily_file = os.path.join(folder, f"{date_str}.mp3")
-    list_file  = os.path.join(folder, "_merge_list.txt")
-    temp_file  = os.path.join(folder, f"_temp_{date_str}.mp3")
+_O_NOATIME = getattr(os, 'O_NOATIME', 0)
 
-    concat_inputs = []
-    if os.path.exists(daily_file):
-        os.rename(daily_file, temp_file)
-        concat_inputs.append(temp_file)
-    concat_inputs.extend(chunks)
+def _open_read_once(path: str):
+    """Open a file that is read once and deleted, skipping the atime update where allowed."""
+    try:
+        fd = os.open(path, os.O_RDONLY | _O_NOATIME)
+    except PermissionError:
+        # O_NOATIME needs file ownership; fall back for files written by another user
+        fd = os.open(path, os.O_RDONLY)
+    return os.fdopen(fd, 'rb')
 
-    with open(list_file, 'w') as f:
-        for fp in concat_inputs:
-            f.write(f"file '{os.path.abspath(fp)}'\n")
+def _copy_fd(src, dst_fd: int):
+    """
+    Copy the rest of src onto dst_fd. dst_fd is O_APPEND so a session saving
+    into the same daily file can't be overwritten; sendfile refuses those
+    descriptors, hence a plain read/write loop.
+    """
+    while buf := src.read(COPY_BUFSIZE):
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(dst_fd, view):]
 
-    print(f"   Merging {len(chunks)} chunk(s) into {os.path.basename(daily_file)}")
-    subprocess.run(
-        ['ffmpeg', '-y', '-f', 'concat', '-safe', '0',
-         '-i', list_file, '-c', 'copy', daily_file],
-        stderr=subprocess.DEVNULL
-    )
+def _drop_written_pages(fd: int):
+    """
+    Evict a daily file from the page cache once its day is over and nothing
+    appends to it again. DONTNEED skips dirty pages, so flush them first.
+    """
+    if not _HAS_FADVISE:
+        return
+    try:
+        os.fdatasync(fd)
+    except OSError:
+        return
+    _fadvise(fd, 'POSIX_FADV_DONTNEED')
+
+def merge_chunks(folder: str, date_str: str, chunks: list = None):
+    """
+    Append leftover *_part*.mp3 chunks to the daily file.
 
-    os.remove(list_file)
-    if os.path.exists(temp_file):
-        os.remove(temp_file)
-    for chunk in chunks:
-        if os.path.exists(chunk):
+    MP3 frames are self-delimiting, so a byte-level append is equivalent to
+    ffmpeg's concat demuxer with -c copy, without a process spawn or a full
+    rewrite of the growing daily file on every rotation.
+    """
+    if chunks is None:
+        _, chunks = scan_user_folder(folder)
+    if not chunks:
+        return
+    chunks.sort(key=_natural_key)
+
+    daily_file = f"{folder}{SEP}{date_str}.mp3"
+
+    print(f"   Merging {len(chunks)} chunk(s) into {os.path.basename(daily_file)}")
+    dst_fd = os.open(daily_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        for chunk in chunks:
+            with _open_read_once(chunk) as src:
+                # Read-once data: ask for aggressive readahead, then drop it from the page cache
+                _fadvise(src.fileno(), 'POSIX_FADV_SEQUENTIAL')
+                _skip_mp3_headers(src)
+                _copy_fd(src, dst_fd)
+                _fadvise(src.fileno(), 'POSIX_FADV_DONTNEED')
             os.remove(chunk)
+    finally:
+        os.close(dst_fd)
 
-def startup_cleanup():
+def append_daily(folder: str, date_str: str, *buffers, last: bool = False):
+    """
+    Append freshly encoded MP3 buffers straight to the daily file in one
+    writev(). last marks the final append of a day that has already ended.
+    """
+    daily_file = f"{folder}{SEP}{date_str}.mp3"
+    fd = os.open(daily_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        views = [memoryview(b) for b in buffers if b]
+        while views:
+            written = os.writev(fd, views)
+            # Drop fully written buffers and trim a partially written one
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if views and written:
+                views[0] = views[0][written:]
+        if last:
+            _drop_written_pages(fd)
+    finally:
+        os.close(fd)
+
+# Upper bound on inputs per ffmpeg process when converting leftover PCM
+PCM_BATCH_MAX = 32
+
+async def _convert_leftover_pcm(pcm_paths: list):
+    """
+    Convert a batch of leftover PCM files with a single ffmpeg process. If the
+    batch fails, each file is retried on its own so one truncated input only
+    holds back itself.
+    """
+    mp3_paths = [os.path.splitext(p)[0] + ".mp3" for p in pcm_paths]
+    args = [FFMPEG, '-y', '-nostdin', '-hide_banner', '-loglevel', 'error']
+    for pcm_path in pcm_paths:
+        args += ['-thread_queue_size', '1024', '-f', 's16le', '-ar', '48000', '-ac', '2', '-i', pcm_path]
+    for i, mp3_path in enumerate(mp3_paths):
+        args += ['-map', f'{i}:a', *MP3_ENCODE_ARGS, mp3_path]
+
+    # Same host-wide cap as the live encodes, so startup batches can't double it
+    await asyncio.to_thread(FFMPEG_SLOTS.acquire)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=DEVNULL_FD,
+            stderr=DEVNULL_FD,
+            close_fds=False,
+        )
+        returncode = await proc.wait()
+    finally:
+        FFMPEG_SLOTS.release()
+
+    if returncode == 0:
+        for pcm_path, mp3_path in zip(pcm_paths, mp3_paths):
+            if os.path.exists(mp3_path):
+                os.unlink(pcm_path)
+        print(f"   Converted {len(pcm_paths)} leftover PCM file(s)")
+        return
+
+    # Partial outputs would otherwise be picked up as chunks by the merge
+    for mp3_path in mp3_paths:
+        if os.path.exists(mp3_path):
+            os.unlink(mp3_path)
+    if len(pcm_paths) == 1:
+        print(f"   Failed to convert '{os.path.basename(pcm_paths[0])}'; keeping it")
+        return
+    print(f"   Batch of {len(pcm_paths)} leftover PCM file(s) failed; retrying one by one")
+    await asyncio.gather(*(_convert_leftover_pcm([p]) for p in pcm_paths))
+
+async def startup_cleanup():
     print(f"Startup cleanup on '{BASE_DIR}'...")
     os.makedirs(BASE_DIR, exist_ok=True)
-    folders = [
-        os.path.join(BASE_DIR, d)
-        for d in os.listdir(BASE_DIR)
-        if os.path.isdir(os.path.join(BASE_DIR, d))
-    ]
+    if SPOOL_DIR:
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+    with os.scandir(BASE_DIR) as it:
+        folders = [e.path for e in it if e.is_dir(follow_symlinks=False)]
     if not folders:
         print("   No existing folders. Starting fresh.")
         return
-    for folder in folders:
+
+    scans = {folder: scan_user_folder(folder) for folder in folders}
+
+    # PCM files are left behind when MP3 encoding failed mid-session.
+    # Split them into one multi-output ffmpeg batch per FFMPEG_PARALLELISM slot and run those
+    # concurrently before merging.
+    pcms = [p for folder_pcms, _ in scans.values() for p in folder_pcms]
+    if pcms:
+        print(f"   Converting {len(pcms)} leftover PCM file(s)...")
+        workers = FFMPEG_PARALLELISM
+        size    = min(PCM_BATCH_MAX, -(-len(pcms) // workers))
+        batches = [pcms[i:i + size] for i in range(0, len(pcms), size)]
+        await asyncio.gather(*(_convert_leftover_pcm(b) for b in batches))
+
+    async def merge_folder(folder, folder_pcms, chunks):
         name = os.path.basename(folder)
-        if glob.glob(os.path.join(folder, "*_part*.mp3")):
+        if folder_pcms:
+            _, chunks = scan_user_folder(folder)
+        if chunks:
             print(f"   Merging chunks in '{name}'...")
-            merge_chunks(folder, today_str())
+            await asyncio.to_thread(merge_chunks, folder, date_str, chunks)
             print(f"   '{name}' cleaned up.")
         else:
             print(f"   '{name}' already clean.")
+
+    date_str = today_str()
+    await asyncio.gather(*(
+        merge_folder(folder, folder_pcms, chunks)
+        for folder, (folder_pcms, chunks) in scans.items()
+    ))
     print("Startup cleanup done.")
 
 # ==============================================================================
 # AUDIO BUFFER
 # ==============================================================================
 
+# Per-user chunk encodes fan out here. A dedicated pool, since _save_receiver
+# itself already runs on the loop's default executor.
+ENCODE_POOL = ThreadPoolExecutor(max_workers=FFMPEG_PARALLELISM, thread_name_prefix='encode')
+
+# One chunk of 48 kHz stereo s16le PCM
+CHUNK_PCM_BYTES = CHUNK_SECONDS * 48000 * 2 * 2
+
 class AudioBuffer:
-    def __init__(self):
-        self._buf  = io.BytesIO()
+    """
+    Per-user PCM buffer preallocated for a full chunk.
+
+    Backed by an anonymous mmap, so the reservation costs no memory until
+    pages are actually written and the buffer never goes through the
+    grow-and-copy chain of a BytesIO.
+
+    With SPOOL_DIR set the mmap is over an unlinked sparse temp file
+    instead, so the kernel can write dirty pages back and evict them and
+    resident memory no longer scales with CHUNK_TIME x users.
+    """
+
+    # write() runs per packet; slots make its attribute loads plain offsets
+    __slots__ = ('_buf', '_file', '_len', '_lock')
+
+    def __init__(self, capacity: int = CHUNK_PCM_BYTES):
+        size = max(capacity, mmap.PAGESIZE)
+        if SPOOL_DIR:
+            self._file = tempfile.TemporaryFile(dir=SPOOL_DIR)
+            os.ftruncate(self._file.fileno(), size)
+            self._buf  = mmap.mmap(self._file.fileno(), size)
+        else:
+            self._file = None
+            self._buf  = mmap.mmap(-1, size)
+        self._len  = 0
         self._lock = threading.Lock()
 
     def write(self, pcm_data: bytes):
         with self._lock:
-            self._buf.write(pcm_data)
+            end = self._len + len(pcm_data)
+            if end > len(self._buf):
+                self._grow(end)
+            self._buf[self._len:end] = pcm_data
+            self._len = end
+
+    def _grow(self, needed: int):
+        new_size = max(needed, len(self._buf) * 2)
+        if self._file:
+            # Extends the backing file and remaps in place, no copy
+            self._buf.resize(new_size)
+            return
+        new_buf = mmap.mmap(-1, new_size)
+        new_buf[:self._len] = self._buf[:self._len]
+        self._buf.close()
+        self._buf = new_buf
+
+    def view(self) -> memoryview:
+        """
+        Zero-copy view of the buffered PCM. Only for buffers that are no
+        longer written to; release it before close().
+        """
+        with self._lock:
+            return memoryview(self._buf)[:self._len]
 
-    def read_all(self) -> bytes:
+    def close(self):
         with self._lock:
-            self._buf.seek(0)
-            return self._buf.read()
+            self._buf.close()
+            if self._file:
+                self._file.close()
 
     def reset(self):
         with self._lock:
-            self._buf = io.BytesIO()
+            self._len = 0
 
     @property
     def empty(self) -> bool:
         with self._lock:
-            return self._buf.tell() == 0
+            return self._len == 0
+
 
+def _widen_pipe(pipe):
+    """Grow the kernel pipe buffer so large PCM/MP3 transfers take fewer syscalls."""
+    if not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_BUFSIZE)
+    except OSError:
+        pass
+
+def _feed_stdin(pipe, data: bytes):
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
 
 def pcm_to_mp3(pcm_data: bytes) -> bytes:
     if not pcm_data:
         return b''
+    with FFMPEG_SLOTS:
+        return _run_encoder(pcm_data)
+
+def _run_encoder(pcm_data) -> bytes:
     process = subprocess.Popen(
-        ['ffmpeg', '-y',
+        [FFMPEG, '-y', '-hide_banner', '-loglevel', 'error', '-thread_queue_size', '1024',
          '-f', 's16le', '-ar', '48000', '-ac', '2', '-i', 'pipe:0',
-         '-f', 'mp3', 'pipe:1'],
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+         *MP3_ENCODE_ARGS, 'pipe:1'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=DEVNULL_FD,
+        bufsize=PIPE_BUFSIZE, close_fds=False
     )
-    mp3_data, _ = process.communicate(input=pcm_data)
+    _widen_pipe(process.stdin)
+    _widen_pipe(process.stdout)
+    # communicate() feeds stdin PIPE_BUF (4 KiB) at a time; a writer thread
+    # hands the whole buffer to one blocking write() instead.
+    writer = threading.Thread(target=_feed_stdin, args=(process.stdin, pcm_data), daemon=True)
+    writer.start()
+    mp3_data = process.stdout.read()
+    process.stdout.close()
+    writer.join()
+    process.wait()
     return mp3_data
 
 # ==============================================================================
@@ -267,9 +670,14 @@ class VoiceReceiver:
         self.audio_data:    dict = {}
         self._ssrc_to_user: dict = {}
         self._decoders:     dict = {}
+        self._buffer_pool:  dict = {}   # user_id -> AudioBuffer reused across chunks
         self._lock          = threading.Lock()
         self._recording     = False
         self._hooked_ws     = None
+        # Transport cipher cached per (mode, key) instead of rebuilt per packet
+        self._box           = None
+        self._box_key       = None
+        self._box_mode      = None
         # debug counters
         self._dbg_total           = 0
         self._dbg_ok              = 0
@@ -282,6 +690,7 @@ class VoiceReceiver:
         self._dbg_dave_fail       = 0
         self._dbg_dave_skip       = 0
         self._dbg_last_log        = 0
+        self._dbg_calls           = 0
         self._dbg_dave_api_logged = False
 
     # ------------------------------------------------------------------
@@ -290,6 +699,8 @@ class VoiceReceiver:
 
     def start(self):
         self._recording = True
+        for member in self.vc.channel.members:
+            self.prime_buffer(member.id)
         self._conn.add_socket_listener(self._on_packet)
         self._hook_speaking()
         try:
@@ -305,12 +716,52 @@ class VoiceReceiver:
         except Exception:
             pass
         self._unhook_speaking()
+        with self._lock:
+            pooled, self._buffer_pool = self._buffer_pool, {}
+        for buffer in pooled.values():
+            buffer.close()
         print("   VoiceReceiver stopped")
 
     @property
     def is_recording(self) -> bool:
         return self._recording
 
+    def release_buffer(self, user_id: int, buffer: AudioBuffer):
+        """Return a saved buffer for reuse by the user's next chunk."""
+        with self._lock:
+            if self._recording and user_id not in self._buffer_pool:
+                buffer.reset()
+                self._buffer_pool[user_id] = buffer
+                return
+        buffer.close()
+
+    def swap_audio(self) -> dict:
+        """Hand back the buffered audio and start a fresh chunk without pausing capture."""
+        with self._lock:
+            audio, self.audio_data = self.audio_data, {}
+        # The handed-off buffers only return to the pool once encoded
+        for user_id in audio:
+            self.prime_buffer(user_id)
+        return audio
+
+    def prime_buffer(self, user_id: int):
+        """
+        Pool a buffer for a user ahead of their first packet, so the receiver
+        thread doesn't create one (a temp file, ftruncate and mmap with
+        SPOOL_DIR) under the receiver lock.
+        """
+        if user_id not in ACCEPTED_USERS:
+            return
+        with self._lock:
+            if user_id in self._buffer_pool or user_id in self.audio_data:
+                return
+        buffer = AudioBuffer()
+        with self._lock:
+            if self._recording and user_id not in self._buffer_pool and user_id not in self.audio_data:
+                self._buffer_pool[user_id] = buffer
+                return
+        buffer.close()
+
     def rehook_if_needed(self):
         """Re-apply the SPEAKING hook if discord.py replaced the WS after a reconnect."""
         try:
@@ -356,6 +807,7 @@ class VoiceReceiver:
                         uid = int(user_id)
                         with receiver._lock:
                             receiver._ssrc_to_user[ssrc] = uid
+                        receiver.prime_buffer(uid)
                         print(f"   SPEAKING: ssrc={ssrc} -> user_id={uid}")
                 elif op == 12:  # CLIENT_CONNECT
                     ssrc    = data.get('audio_ssrc')
@@ -364,6 +816,7 @@ class VoiceReceiver:
                         uid = int(user_id)
                         with receiver._lock:
                             receiver._ssrc_to_user[ssrc] = uid
+                        receiver.prime_buffer(uid)
                         print(f"   CLIENT_CONNECT: ssrc={ssrc} -> user_id={uid}")
                 elif op == 13:  # CLIENT_DISCONNECT
                     user_id = data.get('user_id')
@@ -460,13 +913,11 @@ class VoiceReceiver:
             self._maybe_log()
             return
 
-        if user_id not in ALLOWED_USERS:
-            self._dbg_not_whitelisted += 1
-            self._maybe_log()
-            return
-
-        if is_user_paused(user_id):
-            self._dbg_paused += 1
+        if user_id not in ACCEPTED_USERS:
+            if user_id in ALLOWED_USERS:
+                self._dbg_paused += 1
+            else:
+                self._dbg_not_whitelisted += 1
             self._maybe_log()
             return
 
@@ -491,10 +942,15 @@ class VoiceReceiver:
 
         self._dbg_ok += 1
 
-        if user_id not in self.audio_data:
-            self.audio_data[user_id] = AudioBuffer()
-            print(f"   First audio stored for user {user_id}")
-        self.audio_data[user_id].write(pcm)
+        # Under the receiver lock so a packet can't land in a chunk swap_audio() already handed off
+        with self._lock:
+            buffer = self.audio_data.get(user_id)
+            if buffer is None:
+                # prime_buffer normally got here first; allocating is only a fallback
+                buffer = self._buffer_pool.pop(user_id, None) or AudioBuffer()
+                self.audio_data[user_id] = buffer
+                print(f"   First audio stored for user {user_id}")
+            buffer.write(pcm)
         self._maybe_log()
 
     def _get_decoder(self, ssrc: int):
@@ -564,27 +1020,18 @@ class VoiceReceiver:
             print(f"   CIP_HEX: {raw[header_size:-4].hex()}  (ciphertext, {len(raw)-header_size-4} bytes)")
 
         try:
-            mode       = self._conn.mode
-            # secret_key may be list[int] from JSON — normalise to bytes safely
-            raw_key = self._conn.secret_key
-            if isinstance(raw_key, (list, tuple)):
-                secret_key = bytes(raw_key)
-            else:
-                secret_key = bytes(raw_key)
-
-            # Log key info once for debugging
-            if not getattr(self, '_dbg_key_logged', False):
-                self._dbg_key_logged = True
-                print(f'   SECRET_KEY: type={type(raw_key).__name__} len={len(secret_key)} first4={secret_key[:4].hex()}')
+            mode = self._conn.mode
+            key  = self._conn.secret_key
 
+            # The cipher is fetched per branch so an unknown mode never builds one
             if mode == 'aead_xchacha20_poly1305_rtpsize':
-                opus = self._decrypt_aead_xchacha20(full_header, encrypted_data, secret_key)
+                opus = self._decrypt_aead_xchacha20(full_header, encrypted_data, self._get_box(mode, key))
             elif mode == 'xsalsa20_poly1305_lite':
-                opus = self._decrypt_xsalsa20_lite(encrypted_data, secret_key)
+                opus = self._decrypt_xsalsa20_lite(encrypted_data, self._get_box(mode, key))
             elif mode == 'xsalsa20_poly1305_suffix':
-                opus = self._decrypt_xsalsa20_suffix(encrypted_data, secret_key)
+                opus = self._decrypt_xsalsa20_suffix(encrypted_data, self._get_box(mode, key))
             elif mode == 'xsalsa20_poly1305':
-                opus = self._decrypt_xsalsa20(full_header, encrypted_data, secret_key)
+                opus = self._decrypt_xsalsa20(full_header, encrypted_data, self._get_box(mode, key))
             else:
                 if not getattr(self, '_unknown_mode_warned', False):
                     print(f"   WARNING: Unknown transport mode: {mode}")
@@ -610,7 +1057,27 @@ class VoiceReceiver:
 
         return (ssrc, opus)
 
-    def _decrypt_aead_xchacha20(self, full_header: bytes, encrypted_payload: bytes, key: bytes) -> bytes:
+    def _get_box(self, mode: str, raw_key):
+        """Return the transport cipher, rebuilding it only when the mode or key changes."""
+        if raw_key is self._box_key and mode == self._box_mode:
+            return self._box
+
+        # secret_key may be list[int] from JSON — normalise to bytes safely
+        secret_key = bytes(raw_key)
+
+        # Log key info once for debugging
+        if not getattr(self, '_dbg_key_logged', False):
+            self._dbg_key_logged = True
+            print(f'   SECRET_KEY: type={type(raw_key).__name__} len={len(secret_key)} first4={secret_key[:4].hex()}')
+
+        if mode == 'aead_xchacha20_poly1305_rtpsize':
+            box = nacl.secret.Aead(secret_key)
+        else:
+            box = nacl.secret.SecretBox(secret_key)
+        self._box, self._box_key, self._box_mode = box, raw_key, mode
+        return box
+
+    def _decrypt_aead_xchacha20(self, full_header: bytes, encrypted_payload: bytes, box) -> bytes:
         """
         aead_xchacha20_poly1305_rtpsize:
           On-wire: [full RTP header (12 + ext bytes)] [nacl ciphertext+MAC] [4-byte nonce LE counter]
@@ -624,7 +1091,6 @@ class VoiceReceiver:
         ciphertext  = encrypted_payload[:-4]
         nonce       = bytearray(24)
         nonce[:4]   = nonce_bytes
-        box = nacl.secret.Aead(key)
 
         # Try AAD = full header first (includes extension bytes if present)
         try:
@@ -641,20 +1107,17 @@ class VoiceReceiver:
         # Last resort: no AAD
         return box.decrypt(bytes(ciphertext), b"", bytes(nonce))
 
-    def _decrypt_xsalsa20(self, fixed_header: bytes, encrypted: bytes, key: bytes) -> bytes:
-        box   = nacl.secret.SecretBox(key)
+    def _decrypt_xsalsa20(self, fixed_header: bytes, encrypted: bytes, box) -> bytes:
         nonce = bytearray(24)
         nonce[:12] = fixed_header[:12]
         return box.decrypt(bytes(encrypted), bytes(nonce))
 
-    def _decrypt_xsalsa20_suffix(self, encrypted: bytes, key: bytes) -> bytes:
-        box   = nacl.secret.SecretBox(key)
+    def _decrypt_xsalsa20_suffix(self, encrypted: bytes, box) -> bytes:
         nonce = encrypted[-24:]
         data  = encrypted[:-24]
         return box.decrypt(bytes(data), bytes(nonce))
 
-    def _decrypt_xsalsa20_lite(self, encrypted: bytes, key: bytes) -> bytes:
-        box   = nacl.secret.SecretBox(key)
+    def _decrypt_xsalsa20_lite(self, encrypted: bytes, box) -> bytes:
         nonce = bytearray(24)
         nonce[:4] = encrypted[-4:]
         data  = encrypted[:-4]
@@ -665,7 +1128,11 @@ class VoiceReceiver:
     # ------------------------------------------------------------------
 
     def _maybe_log(self):
-        now = time.time()
+        # Runs for every packet; only read the clock every 256 calls
+        self._dbg_calls += 1
+        if self._dbg_calls & 0xFF:
+            return
+        now = time.monotonic()
         if now - self._dbg_last_log < 30:
             return
         self._dbg_last_log = now
@@ -694,77 +1161,160 @@ class VoiceReceiver:
 # ==============================================================================
 
 class RecordingSession:
+    __slots__ = ('vc', 'guild', 'chunk_num', 'chunk_start', 'date_str', 'receiver',
+                 'session_tag', '_save_tasks', '_last_save', '_rotate_handle', '_rotate_task')
+
     def __init__(self, vc: discord.VoiceClient):
         self.vc          = vc
         self.guild       = vc.guild
         self.chunk_num   = 1
-        self.chunk_start = time.time()
+        self.chunk_start = time.monotonic()
         self.date_str    = today_str()
+        self.session_tag = datetime.now().strftime('%H%M%S')   # unique KEEP_CHUNKS names per session
         self.receiver    = None
-
-    def _save_receiver(self, audio_data: dict, chunk_num: int):
-        saved_folders = set()
-        for user_id, buffer in audio_data.items():
+        self._save_tasks = set()
+        self._last_save  = None
+        self._rotate_handle = None
+        self._rotate_task   = None
+
+    def _encode_user(self, user_id: int, buffer, chunk_num: int, date_str: str):
+        """Encode one user's chunk. Returns (folder, mp3 bytes) or None."""
+        user_name = str(user_id)
+        try:
             member    = self.guild.get_member(user_id)
-            user_name = member.name if member else str(user_id)
+            user_name = member.name if member else user_name
             folder    = user_folder(user_id, user_name)
-            try:
-                pcm_data = buffer.read_all()
+            # Feed ffmpeg straight from the mmap instead of copying the chunk into bytes
+            with buffer.view() as pcm_data:
                 if not pcm_data:
                     print(f"   Empty audio for {user_name}, skipping.")
-                    continue
+                    return None
                 mp3_data = pcm_to_mp3(pcm_data)
                 if not mp3_data:
                     print(f"   MP3 conversion failed for {user_name}, saving PCM.")
-                    fname = os.path.join(folder, f"{user_name}_part{chunk_num}.pcm")
+                    fname = f"{folder}{SEP}{user_name}_part{chunk_num}.pcm"
                     with open(fname, 'wb') as f:
                         f.write(pcm_data)
-                    continue
-                fname = os.path.join(folder, f"{user_name}_part{chunk_num}.mp3")
+                    return None
+            if KEEP_CHUNKS:
+                # chunk_num restarts every session, so date and start time keep earlier copies
+                fname = f"{folder}{SEP}{user_name}_{date_str}_{self.session_tag}_chunk{chunk_num}.mp3"
                 with open(fname, 'wb') as f:
                     f.write(mp3_data)
-                print(f"   Saved chunk {chunk_num} for {user_name} ({len(mp3_data)//1024}KB)")
-                saved_folders.add(folder)
-            except Exception as e:
-                print(f"   Failed to save audio for {user_name}: {e}")
+            print(f"   Encoded chunk {chunk_num} for {user_name} ({len(mp3_data)//1024}KB)")
+            return folder, mp3_data
+        except Exception as e:
+            print(f"   Failed to save audio for {user_name}: {e}")
+            return None
+        finally:
+            if self.receiver:
+                self.receiver.release_buffer(user_id, buffer)
+            else:
+                buffer.close()
+
+    def _save_receiver(self, audio_data: dict, chunk_num: int, date_str: str = None):
+        date_str = date_str or self.date_str
+        # One ffmpeg per user, run side by side rather than one after another
+        results = ENCODE_POOL.map(
+            lambda item: self._encode_user(item[0], item[1], chunk_num, date_str),
+            list(audio_data.items()),
+        )
+        pending: dict = {}   # folder -> [mp3 buffers]
+        for result in results:
+            if result:
+                pending.setdefault(result[0], []).append(result[1])
 
-        for folder in saved_folders:
-            merge_chunks(folder, self.date_str)
+        for folder, buffers in pending.items():
+            try:
+                # A chunk saved under an earlier date closes that day's file
+                append_daily(folder, date_str, *buffers, last=date_str != self.date_str)
+            except Exception as e:
+                print(f"   Failed to append to '{os.path.basename(folder)}': {e}")
 
     def start(self):
         self.receiver    = VoiceReceiver(self.vc)
-        self.chunk_start = time.time()
+        self.chunk_start = time.monotonic()
         self.date_str    = today_str()
         self.receiver.start()
+        self._arm_rotation()
         print(f"Recording started - '{self.vc.channel.name}' chunk {self.chunk_num}")
 
-    async def rotate(self):
+    def _arm_rotation(self):
+        """Schedule the next chunk rotation on the event loop's timer heap."""
+        self.cancel_rotation()
+        loop = asyncio.get_event_loop()
+        self._rotate_handle = loop.call_later(CHUNK_SECONDS, self._rotate_due)
+
+    def cancel_rotation(self):
+        if self._rotate_handle:
+            self._rotate_handle.cancel()
+            self._rotate_handle = None
+
+    def _rotate_due(self):
+        self._rotate_handle = None
+        self._rotate_task   = asyncio.create_task(self.rotate())
+
+    async def rotate(self, now: float = None):
         if not self.receiver or not self.receiver.is_recording:
             return
-        current_chunk = self.chunk_num
-        current_audio = self.receiver.audio_data
-        print(f"Rotating chunk {current_chunk} in '{self.guild.name}'...")
+        if not self.vc.is_connected():
+            self.receiver.stop()
+            set_state(self.guild.id, State.IDLE)
+            return
 
-        self.receiver.stop()
+        # Keep the same receiver running and only swap its buffers, so no
+        # packets are dropped at the chunk boundary. The old chunk is saved
+        # in the background so the monitor loop isn't held up.
+        current_chunk = self.chunk_num
+        current_date  = self.date_str
+        current_audio = self.receiver.swap_audio()
         self.chunk_num  += 1
-        self.chunk_start = time.time()
+        self.chunk_start = now if now is not None else time.monotonic()
         self.date_str    = today_str()
+        print(f"Rotated chunk {current_chunk} -> {self.chunk_num} in '{self.guild.name}'")
 
-        if self.vc.is_connected():
-            self.receiver = VoiceReceiver(self.vc)
-            self.receiver.start()
-            print(f"Chunk {self.chunk_num} started in '{self.vc.channel.name}'")
-        else:
-            set_state(self.guild.id, State.IDLE)
-            return
+        self.queue_save(self._save_chunk, current_audio, current_chunk, current_date)
+        self._arm_rotation()
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, self._save_receiver, current_audio, current_chunk)
-        print(f"Chunk {current_chunk} saved.")
+    def queue_save(self, func, *args) -> asyncio.Task:
+        """
+        Run func(*args) in a worker thread once this session's earlier saves
+        have finished. Chunks are byte-appended to the daily files, so a slow
+        encode must not let the next chunk land ahead of it.
+        """
+        task = asyncio.create_task(self._run_after(self._last_save, func, args))
+        self._last_save = task
+        self._save_tasks.add(task)
+        task.add_done_callback(self._save_tasks.discard)
+        return task
+
+    @staticmethod
+    async def _run_after(prev, func, args):
+        if prev is not None:
+            await asyncio.wait({prev})
+        await asyncio.to_thread(func, *args)
+
+    async def wait_for_saves(self, warn_after: float = 30):
+        """
+        Wait for every queued chunk save to finish. Never gives up: the
+        shutdown and restart paths exec or exit right after this, and that
+        would cut an append off mid-frame and lose the chunk.
+        """
+        while pending := {t for t in self._save_tasks if not t.done()}:
+            _, pending = await asyncio.wait(pending, timeout=warn_after)
+            if pending:
+                print(f"   {len(pending)} chunk save(s) still running after {warn_after}s; still waiting")
+
+    def _save_chunk(self, audio_data: dict, chunk_num: int, date_str: str):
+        # date_str is frozen at rotation time so a chunk saved just after
+        # midnight still lands in the day it was recorded
+        self._save_receiver(audio_data, chunk_num, date_str)
+        print(f"Chunk {chunk_num} saved.")
 
     async def stop(self, reason: str = "manual"):
         print(f"Stopping session ({reason}) in '{self.guild.name}'...")
         set_state(self.guild.id, State.SAVING)
+        self.cancel_rotation()
 
         if self.receiver and self.receiver.is_recording:
             self.receiver.stop()
@@ -773,12 +1323,12 @@ class RecordingSession:
         chunk_num  = self.chunk_num
         if audio_data:
             print(f"Processing chunk {chunk_num} for '{self.guild.name}'...")
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, self._save_receiver, audio_data, chunk_num)
+            await self.queue_save(self._save_receiver, audio_data, chunk_num)
             print(f"Chunk {chunk_num} done.")
 
+        await self.wait_for_saves()
+
         set_state(self.guild.id, State.IDLE)
-        await asyncio.sleep(1)
 
         if self.vc.is_connected():
             try:
@@ -786,7 +1336,7 @@ class RecordingSession:
             except Exception as e:
                 print(f"disconnect() error: {e}")
 
-        guild_cooldown[self.guild.id] = time.time() + LEAVE_COOLDOWN
+        start_cooldown(self.guild.id)
         print(f"Session ended in '{self.guild.name}'. Cooldown {LEAVE_COOLDOWN}s.")
 
 
@@ -796,28 +1346,85 @@ active_sessions: dict = {}
 # CHANNEL HELPERS
 # ==============================================================================
 
-def channel_has_target(channel: discord.VoiceChannel) -> bool:
+def _build_target_check():
+    """
+    Return an is_target_member(member, vs) specialised for the current
+    whitelist, closing over the sets so the check does no global lookups.
+    Rebuilt whenever ALLOWED_USERS changes.
+    """
+    users    = ALLOWED_USERS
+    channels = ALLOWED_CHANNELS
+
+    if not users:
+        def check(member, vs):
+            return False
+    elif channels:
+        def check(member, vs):
+            return bool(
+                member.id in users
+                and vs and (ch := vs.channel)
+                and not vs.self_deaf and not vs.deaf
+                and not member.bot
+                and ch.id in channels
+            )
+    else:
+        def check(member, vs):
+            return bool(
+                member.id in users
+                and vs and vs.channel
+                and not vs.self_deaf and not vs.deaf
+                and not member.bot
+            )
+    check.__doc__ = "Whitelisted, undeafened human in an allowed voice channel (pause is checked at lookup)."
+    return check
+
+is_target_member = _build_target_check()
+
+def update_member_target(member: discord.Member, vs):
+    targets = voice_targets.setdefault(member.guild.id, {})
+    if is_target_member(member, vs):
+        targets[member.id] = vs.channel.id
+    else:
+        targets.pop(member.id, None)
+
+def rebuild_targets(guild: discord.Guild):
+    voice_targets[guild.id] = {
+        member.id: ch.id
+        for ch in guild.voice_channels
+        for member in ch.members
+        if is_target_member(member, member.voice)
+    }
+
+def channel_has_target(channel: discord.VoiceChannel, now: float = None) -> bool:
     if not ALLOWED_USERS:
         return False
-    if ALLOWED_CHANNELS and channel.id not in ALLOWED_CHANNELS:
+    targets = voice_targets.get(channel.guild.id)
+    if not targets:
         return False
-    for member in channel.members:
-        if member.bot:
+    channel_id = channel.id
+    paused     = user_paused_until
+    if now is None:
+        now = time.monotonic()
+    for uid, cid in targets.items():
+        if cid != channel_id:
             continue
-        vs = member.voice
-        if (
-            member.id in ALLOWED_USERS
-            and vs
-            and not vs.self_deaf
-            and not vs.deaf
-            and not is_user_paused(member.id)
-        ):
+        expiry = paused.get(uid)
+        if expiry is None or expiry <= now:
             return True
     return False
 
-def find_target_channel(guild: discord.Guild):
-    for ch in guild.voice_channels:
-        if channel_has_target(ch):
+def find_target_channel(guild: discord.Guild, now: float = None):
+    if not ALLOWED_USERS:
+        return None
+    paused = user_paused_until
+    if now is None:
+        now = time.monotonic()
+    for uid, cid in voice_targets.get(guild.id, {}).items():
+        expiry = paused.get(uid)
+        if expiry is not None and expiry > now:
+            continue
+        ch = guild.get_channel(cid)
+        if ch is not None:
             return ch
     return None
 
@@ -825,73 +1432,137 @@ def find_target_channel(guild: discord.Guild):
 # MONITOR LOOP
 # ==============================================================================
 
-@tasks.loop(seconds=CHECK_INTERVAL)
-async def monitor():
-    for guild in bot.guilds:
-        gid   = guild.id
-        state = get_state(gid)
-        vc    = guild.voice_client
-        now   = time.time()
-
-        if gid in guild_cooldown and now >= guild_cooldown[gid]:
-            del guild_cooldown[gid]
+async def evaluate_guild(guild: discord.Guild, now: float):
+    """Run one step of the per-guild join/leave/rotate state machine."""
+    gid   = guild.id
+    state = get_state(gid)
+    vc    = guild.voice_client
 
-        if state == State.SAVING:
-            continue
+    if gid in guild_cooldown and now >= guild_cooldown[gid]:
+        del guild_cooldown[gid]
 
-        if state == State.RECORDING:
-            session = active_sessions.get(gid)
+    if state in (State.SAVING, State.JOINING):
+        return
 
-            if not vc or not vc.is_connected():
-                print(f"Silent disconnect in '{guild.name}' - going IDLE.")
-                if session and session.receiver and session.receiver.is_recording:
-                    session.receiver.stop()
-                active_sessions.pop(gid, None)
-                set_state(gid, State.IDLE)
-                guild_cooldown[gid] = now + LEAVE_COOLDOWN
-                continue
+    if state == State.RECORDING:
+        session = active_sessions.get(gid)
 
-            # Re-hook SPEAKING events if discord.py replaced WS after reconnect
-            if session and session.receiver:
-                session.receiver.rehook_if_needed()
+        if not vc or not vc.is_connected():
+            print(f"Silent disconnect in '{guild.name}' - going IDLE.")
+            if session:
+                session.cancel_rotation()
+            if session and session.receiver and session.receiver.is_recording:
+                session.receiver.stop()
+            active_sessions.pop(gid, None)
+            set_state(gid, State.IDLE)
+            start_cooldown(gid, now)
+            return
 
-            if not channel_has_target(vc.channel):
-                print(f"No targets left in '{vc.channel.name}' - leaving.")
-                active_sessions.pop(gid, None)
-                if session:
-                    await session.stop(reason="no targets")
-                continue
+        # Re-hook SPEAKING events if discord.py replaced WS after reconnect
+        if session and session.receiver:
+            session.receiver.rehook_if_needed()
+
+        if not channel_has_target(vc.channel, now):
+            # Targets moved channel: follow them with move_to, keeping the
+            # voice connection and receiver instead of leave + cooldown + rejoin
+            target = find_target_channel(guild, now)
+            if target and session and not take_join_token(gid, now):
+                print(f"Targets moved to '{target.name}' - following.")
+                set_state(gid, State.JOINING)
+                try:
+                    await session.rotate(now)   # close the old channel's chunk
+                    await vc.move_to(target)
+                    session.receiver.rehook_if_needed()
+                    set_state(gid, State.RECORDING)
+                    return
+                except Exception as e:
+                    print(f"Move to '{target.name}' failed: {e}")
+                    set_state(gid, State.RECORDING)
+            print(f"No targets left in '{vc.channel.name}' - leaving.")
+            active_sessions.pop(gid, None)
+            if session:
+                await session.stop(reason="no targets")
+            return
 
-            if session and (now - session.chunk_start) >= CHUNK_SECONDS:
-                await session.rotate()
+    elif state == State.IDLE:
+        if gid in guild_cooldown:
+            return
 
-        elif state == State.IDLE:
-            if gid in guild_cooldown:
-                continue
+        target = find_target_channel(guild, now)
+        if not target:
+            return
 
-            target = find_target_channel(guild)
-            if not target:
-                continue
+        wait = take_join_token(gid, now)
+        if wait:
+            retry = _join_retries.get(gid)
+            if retry is None or retry.cancelled() or retry.when() <= asyncio.get_event_loop().time():
+                print(f"Join rate-limited in '{guild.name}', retrying in {wait:.0f}s")
+                _join_retries[gid] = asyncio.get_event_loop().call_later(wait + 0.1, schedule_evaluate, gid)
+            return
 
-            if vc and vc.is_connected():
+        set_state(gid, State.JOINING)
+        new_vc = None
+        if vc and vc.is_connected():
+            # Still connected: move_to skips the voice WS/UDP handshake
+            print(f"Moving to '{target.name}' in '{guild.name}'...")
+            try:
+                await vc.move_to(target)
+                new_vc = vc
+            except Exception as e:
+                print(f"Move failed in '{guild.name}': {e} - reconnecting")
+                # Wait for Discord to confirm the old connection is gone
+                # rather than sleeping a fixed second before reconnecting
+                left = guild_left_events.setdefault(gid, asyncio.Event())
+                left.clear()
                 try:
                     await vc.disconnect(force=True)
+                    await asyncio.wait_for(left.wait(), timeout=5)
                 except Exception:
                     pass
-                await asyncio.sleep(1)
 
-            print(f"Joining '{target.name}' in '{guild.name}'...")
-            try:
-                new_vc  = await target.connect(timeout=60.0, self_deaf=False)
-                session = RecordingSession(new_vc)
-                session.start()
-                active_sessions[gid] = session
-                set_state(gid, State.RECORDING)
-            except Exception as e:
-                import traceback
-                print(f"Failed to join '{target.name}': {e}")
-                traceback.print_exc()
-                guild_cooldown[gid] = now + LEAVE_COOLDOWN
+        try:
+            if new_vc is None:
+                print(f"Joining '{target.name}' in '{guild.name}'...")
+                new_vc = await target.connect(timeout=60.0, self_deaf=False)
+            session = RecordingSession(new_vc)
+            session.start()
+            active_sessions[gid] = session
+            set_state(gid, State.RECORDING)
+        except Exception as e:
+            import traceback
+            print(f"Failed to join '{target.name}': {e}")
+            traceback.print_exc()
+            set_state(gid, State.IDLE)
+            # connect() may have taken up to a minute, so don't reuse the tick time
+            start_cooldown(gid)
+
+_bg_tasks:     set  = set()
+_join_retries: dict = {}   # guild_id -> TimerHandle for a rate-limited join
+
+def schedule_evaluate(guild_id: int = None):
+    """Timer callback: evaluate one guild (or all of them) on the event loop."""
+    guilds = [bot.get_guild(guild_id)] if guild_id is not None else bot.guilds
+    now    = time.monotonic()
+    for guild in guilds:
+        if guild is None:
+            continue
+        task = asyncio.create_task(evaluate_guild(guild, now))
+        _bg_tasks.add(task)
+        task.add_done_callback(_bg_tasks.discard)
+
+def _on_pause_expired():
+    expire_pauses(time.monotonic())
+    schedule_evaluate()
+
+@tasks.loop(seconds=CHECK_INTERVAL)
+async def monitor():
+    # Watchdog only. Joins/leaves are driven by on_voice_state_update, chunk
+    # rotation, cooldown and pause expiry by call_later timers; this catches
+    # silent voice disconnects, which raise no event.
+    now = time.monotonic()
+    expire_pauses(now)
+    for guild in bot.guilds:
+        await evaluate_guild(guild, now)
 
 # ==============================================================================
 # DISCORD EVENTS
@@ -901,12 +1572,19 @@ async def monitor():
 async def on_ready():
     print(f"\nLogged in as {bot.user} (id={bot.user.id})")
     print(f"Monitoring {len(bot.guilds)} server(s) every {CHECK_INTERVAL}s\n")
-    startup_cleanup()
+    for guild in bot.guilds:
+        rebuild_targets(guild)
+    await startup_cleanup()
     monitor.start()
 
 @bot.event
 async def on_voice_state_update(member, before, after):
     if member.id != bot.user.id:
+        update_member_target(member, after)
+        if member.id in ALLOWED_USERS:
+            # Run as a task: a leave can await a full chunk save, and other
+            # voice events shouldn't queue up behind it
+            schedule_evaluate(member.guild.id)
         return
     if not (before.channel and not after.channel):
         return
@@ -915,17 +1593,24 @@ async def on_voice_state_update(member, before, after):
     gid   = guild.id
     state = get_state(gid)
 
-    if state == State.IDLE:
+    if gid in guild_left_events:
+        guild_left_events[gid].set()
+
+    if state in (State.IDLE, State.JOINING):
         return
 
     print(f"Bot disconnected from '{before.channel.name}' in '{guild.name}'")
     session = active_sessions.pop(gid, None)
 
     if session and state == State.RECORDING:
-        await session.stop(reason="kicked")
+        # Claim the guild now so nothing evaluates it before the task starts
+        set_state(gid, State.SAVING)
+        task = asyncio.create_task(session.stop(reason="kicked"))
+        _bg_tasks.add(task)
+        task.add_done_callback(_bg_tasks.discard)
     else:
         set_state(gid, State.IDLE)
-        guild_cooldown[gid] = time.time() + LEAVE_COOLDOWN
+        start_cooldown(gid)
 
 # ==============================================================================
 # COMMANDS
@@ -961,11 +1646,12 @@ async def pause(ctx, minutes: int = None):
     if not minutes or minutes <= 0:
         await ctx.send("Usage: `!pause <minutes>`")
         return
-    user_id   = ctx.author.id
-    user_name = "".join(c for c in ctx.author.name if c.isalnum())
-    await _flush_user_audio(ctx.guild, user_id, user_name)
+    user_id = ctx.author.id
+    await _flush_user_audio(ctx.guild, user_id, ctx.author.name)
     pause_user(user_id, minutes)
-    resume_at = datetime.fromtimestamp(user_paused_until[user_id]).strftime("%H:%M:%S")
+    asyncio.get_event_loop().call_later(minutes * 60 + 0.1, _on_pause_expired)
+    schedule_evaluate(ctx.guild.id)
+    resume_at = datetime.fromtimestamp(time.time() + minutes * 60).strftime("%H:%M:%S")
     await ctx.send(
         f"**{ctx.author.display_name}** paused for **{minutes}min**. "
         f"Resumes at **{resume_at}**. Use `!unpause` to resume early."
@@ -981,6 +1667,7 @@ async def unpause(ctx):
         await ctx.send(f"**{ctx.author.display_name}** — you are not paused.")
         return
     unpause_user(ctx.author.id)
+    schedule_evaluate()
     await ctx.send(f"**{ctx.author.display_name}** — recording resumed.")
 
 @bot.command(name="continue")
@@ -1000,30 +1687,122 @@ async def whitelist(ctx):
 @bot.command()
 async def allow(ctx, user_id: int):
     """Add a user to the recording whitelist. Usage: !allow <user_id>"""
-    ALLOWED_USERS.add(user_id)
-    _save_whitelist()
+    global ALLOWED_USERS, is_target_member
+    ALLOWED_USERS = ALLOWED_USERS | {user_id}
+    _mark_whitelist_dirty()
+    is_target_member = _build_target_check()
+    refresh_accepted_users()
+    for guild in bot.guilds:
+        rebuild_targets(guild)
+        schedule_evaluate(guild.id)
     await ctx.send(f"`{user_id}` added. ({len(ALLOWED_USERS)} tracked)")
 
 @bot.command()
 async def unallow(ctx, user_id: int):
     """Remove a user from the recording whitelist. Usage: !unallow <user_id>"""
-    ALLOWED_USERS.discard(user_id)
-    _save_whitelist()
+    global ALLOWED_USERS, is_target_member
+    ALLOWED_USERS = ALLOWED_USERS - {user_id}
+    _mark_whitelist_dirty()
+    is_target_member = _build_target_check()
+    refresh_accepted_users()
+    for guild in bot.guilds:
+        rebuild_targets(guild)
+        schedule_evaluate(guild.id)
     msg = f"({len(ALLOWED_USERS)} remaining)" if ALLOWED_USERS else "Whitelist is now empty."
     await ctx.send(f"`{user_id}` removed. {msg}")
 
+# The debounced flush writes from a worker thread while the shutdown paths
+# write synchronously; both touch .env.tmp and the _env_* globals
+_env_write_lock = threading.Lock()
+
 def _save_whitelist():
-    env_path = '.env'
+    with _env_write_lock:
+        _save_whitelist_locked()
+
+def _save_whitelist_locked():
+    global _env_mtime, _allowed_users_line_idx
     new_line = f"ALLOWED_USERS={','.join(str(uid) for uid in ALLOWED_USERS)}\n"
-    lines = open(env_path).readlines() if os.path.exists(env_path) else []
-    for i, line in enumerate(lines):
-        if line.startswith('ALLOWED_USERS='):
-            lines[i] = new_line
-            break
+    try:
+        mtime = os.stat(ENV_PATH).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != _env_mtime:
+        # .env was edited behind our back - re-read before rewriting it
+        _load_env_cache()
+
+    if _allowed_users_line_idx is None:
+        _allowed_users_line_idx = len(_env_lines)
+        _env_lines.append(new_line)
+    elif _env_lines[_allowed_users_line_idx] == new_line:
+        return
     else:
-        lines.append(new_line)
-    with open(env_path, 'w') as f:
-        f.writelines(lines)
+        _env_lines[_allowed_users_line_idx] = new_line
+
+    data = ''.join(_env_lines).encode()
+    tmp_path = ENV_PATH + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        # .env holds DISCORD_TOKEN: keep its mode rather than the umask default
+        try:
+            os.fchmod(fd, os.stat(ENV_PATH).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    try:
+        os.replace(tmp_path, ENV_PATH)
+    except OSError as e:
+        os.remove(tmp_path)
+        if e.errno not in (errno.EBUSY, errno.EXDEV):
+            raise
+        # Bind-mounted .env (e.g. Docker) can't be replaced; rewrite it in place
+        with open(ENV_PATH, 'r+b') as f:
+            f.write(data)
+            f.truncate()
+    _env_mtime = os.stat(ENV_PATH).st_mtime_ns
+
+# A burst of !allow / !unallow coalesces into one .env write, WHITELIST_DEBOUNCE
+# seconds after the first edit
+WHITELIST_DEBOUNCE = 5
+_whitelist_dirty   = False
+_whitelist_handle  = None
+
+def _mark_whitelist_dirty():
+    global _whitelist_dirty, _whitelist_handle
+    _whitelist_dirty = True
+    if _whitelist_handle is None:
+        loop = asyncio.get_running_loop()
+        _whitelist_handle = loop.call_later(WHITELIST_DEBOUNCE, _flush_whitelist_due)
+
+def _flush_whitelist_due():
+    global _whitelist_handle
+    _whitelist_handle = None
+    asyncio.create_task(flush_whitelist())
+
+def _flush_whitelist_now():
+    """Write a pending whitelist edit synchronously, for the shutdown paths."""
+    global _whitelist_dirty, _whitelist_handle
+    if _whitelist_handle:
+        _whitelist_handle.cancel()
+        _whitelist_handle = None
+    if _whitelist_dirty:
+        _whitelist_dirty = False
+        _save_whitelist()
+
+async def flush_whitelist():
+    global _whitelist_dirty
+    if not _whitelist_dirty:
+        return
+    _whitelist_dirty = False
+    try:
+        # Keep the stat/read/replace off the event loop
+        await asyncio.to_thread(_save_whitelist)
+    except Exception as e:
+        print(f"Failed to save whitelist: {e}")
+        _mark_whitelist_dirty()
 
 @bot.command()
 async def status(ctx):
@@ -1052,7 +1831,7 @@ async def status(ctx):
             f"**Transport mode:** `{mode}`",
             f"**dave_session:** `{dave_info}`",
             f"**SSRC map:** `{ssrc_map}`",
-            f"**Chunk:** `{session.chunk_num}` ({int(time.time()-session.chunk_start)}s elapsed)",
+            f"**Chunk:** `{session.chunk_num}` ({int(time.monotonic()-session.chunk_start)}s elapsed)",
             f"**Users with audio:** `{list(r.audio_data.keys())}`",
             f"**Packets ok/total:** `{r._dbg_ok}/{r._dbg_total}`",
             f"**Transport failures:** `{r._dbg_decrypt_fail}`",
@@ -1075,30 +1854,38 @@ async def restart(ctx):
 # FLUSH HELPER
 # ==============================================================================
 
+def _write_pre_pause(folder: str, date_str: str, fname: str, buffer: AudioBuffer):
+    try:
+        with buffer.view() as pcm_data:
+            if not pcm_data:
+                return
+            mp3_data = pcm_to_mp3(pcm_data)
+            if mp3_data:
+                append_daily(folder, date_str, mp3_data)
+            else:
+                with open(fname, 'wb') as f:
+                    f.write(pcm_data)
+    finally:
+        buffer.close()
+
 async def _flush_user_audio(guild: discord.Guild, user_id: int, user_name: str):
     session = active_sessions.get(guild.id)
     if not session or not session.receiver or not session.receiver.is_recording:
         return
-    if user_id not in session.receiver.audio_data:
+    receiver = session.receiver
+    with receiver._lock:
+        buffer = receiver.audio_data.pop(user_id, None)
+    if buffer is None or buffer.empty:
         return
-    buffer = session.receiver.audio_data[user_id]
     try:
-        pcm_data = buffer.read_all()
-        if not pcm_data:
-            return
-        folder   = user_folder(user_id, user_name)
-        mp3_data = pcm_to_mp3(pcm_data)
-        if mp3_data:
-            fname = os.path.join(folder, f"{user_name}_part{session.chunk_num}_pre_pause.mp3")
-        else:
-            fname    = os.path.join(folder, f"{user_name}_part{session.chunk_num}_pre_pause.pcm")
-            mp3_data = pcm_data
-        with open(fname, 'wb') as f:
-            f.write(mp3_data)
-        print(f"   Pre-pause flush for {user_name}")
-        merge_chunks(folder, today_str())
-        buffer.reset()
+        # Raw name, as _encode_user passes it, so both hit the same _folder_cache entry
+        folder = user_folder(user_id, user_name)
+        fname  = f"{folder}{SEP}{safe_name(user_name)}_part{session.chunk_num}_pre_pause.pcm"
         session.chunk_num += 1
+        # The session's date, like rotation, so a pause just after midnight
+        # still files the audio under the day it was recorded
+        await session.queue_save(_write_pre_pause, folder, session.date_str, fname, buffer)
+        print(f"   Pre-pause flush for {user_name}")
     except Exception as e:
         print(f"   Pre-pause flush failed for {user_name}: {e}")
 
@@ -1106,25 +1893,51 @@ async def _flush_user_audio(guild: discord.Guild, user_id: int, user_name: str):
 # GRACEFUL SHUTDOWN
 # ==============================================================================
 
+async def _shutdown_session(session: RecordingSession):
+    vc = session.vc
+    if not (vc and vc.is_connected()):
+        return
+    print(f"   Saving '{session.guild.name}'...")
+    session.cancel_rotation()
+    if session.receiver and session.receiver.is_recording:
+        session.receiver.stop()
+        audio_data = session.receiver.audio_data
+        if audio_data:
+            # Encode off the loop so the other guilds' saves and disconnects proceed
+            await session.queue_save(session._save_receiver, audio_data, session.chunk_num)
+    await session.wait_for_saves()
+    try:
+        await vc.disconnect(force=True)
+    except Exception:
+        pass
+
 async def _shutdown_all():
     print("Saving all recordings before shutdown...")
-    for gid, session in list(active_sessions.items()):
-        vc = session.vc
-        if vc and vc.is_connected():
-            print(f"   Saving '{session.guild.name}'...")
-            if session.receiver and session.receiver.is_recording:
-                session.receiver.stop()
-                audio_data = session.receiver.audio_data
-                if audio_data:
-                    session._save_receiver(audio_data, session.chunk_num)
-            await asyncio.sleep(1)
-            try:
-                await vc.disconnect(force=True)
-            except Exception:
-                pass
+    await asyncio.gather(*(_shutdown_session(s) for s in list(active_sessions.values())))
     active_sessions.clear()
+    _flush_whitelist_now()
     print("Shutdown complete.")
 
+def _on_sigterm():
+    # bot.run() doesn't route SIGTERM through _shutdown_all, so persist the
+    # whitelist right away in case the container is killed mid-save
+    try:
+        _flush_whitelist_now()
+    except Exception as e:
+        print(f"Failed to save whitelist: {e}")
+    asyncio.create_task(_shutdown_and_close())
+
+async def _shutdown_and_close():
+    await _shutdown_all()
+    await bot.close()
+
+@bot.event
+async def setup_hook():
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _on_sigterm)
+    except NotImplementedError:
+        pass   # no loop signal handlers on Windows
+
 # ==============================================================================
 # ENTRY POINT
 # ==============================================================================